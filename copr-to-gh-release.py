@@ -1,15 +1,22 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
+import json
+import random
 import re
+import sys
 import tempfile
-from concurrent.futures.thread import ThreadPoolExecutor
-from os import makedirs
-from os.path import dirname, basename
-from pprint import pprint
-from subprocess import check_output as run, check_call as exe, CalledProcessError, STDOUT
-from time import sleep
+from os import makedirs, replace
+from os.path import basename, expanduser
+from urllib.parse import parse_qs, quote, urlsplit
+from subprocess import check_output as run
 
-import requests
+import httpx
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 parser = argparse.ArgumentParser(description="COPR to GH Release Synchronizer",
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -26,14 +33,23 @@ parser.add_argument("--tag", required=False, type=str,
 parser.add_argument("--fetch-tags", required=False, action="store_true", default=False,
                     help="fetch all tags")
 parser.add_argument("--clobber-assets", required=False, action="store_true", default=False,
-                    help="for releases that already exist do clobber (re-upload) the assets")
+                    help="for releases that already exist do clobber (re-upload) the assets that are missing "
+                         "or differ in size")
 parser.add_argument("--no-ignore-epoch", dest="ignore_epoch", required=False, action="store_false", default=True,
                     help="ignore rpm epoch in version matches")
 parser.add_argument("--wait-build", required=False, action="store_true", default=True,
                     help="if we see pending or running builds we'll loop waiting for them to complete")
+parser.add_argument("--poll-initial", required=False, type=float, default=2,
+                    help="initial delay in seconds between polls while waiting for builds")
+parser.add_argument("--poll-max", required=False, type=float, default=60,
+                    help="maximum delay in seconds between polls while waiting for builds")
+parser.add_argument("--cache-dir", required=False, type=str, default=expanduser("~/.cache/copr-to-gh-release"),
+                    help="directory to cache completed build results in across runs")
+
+github_remote_re = re.compile(r"^(?:https://github\.com/|(?:ssh://)?git@github\.com[:/])([^/]+/[^/]+?)(?:\.git)?/?$")
 
 
-def main():
+async def main():
     args = parser.parse_args()
     owner_name = args.owner_name
     project_name = args.project_name
@@ -44,182 +60,378 @@ def main():
     clobber_assets = args.clobber_assets
     ignore_epoch = args.ignore_epoch
     wait_build = args.wait_build
-    spin_loop_delay = 30
-
-    with ThreadPoolExecutor(max_workers=10) as tpe:
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            with (requests.Session() as s):
-                def check_url_exists(url):
-                    with s.head(url) as r:
-                        return r.status_code == 200
-
-                def get_builds():
-                    build_metadata = {}
-                    retry = True
-                    while retry:
-                        retry = False
-                        with s.get("https://copr.fedorainfracloud.org/api_3/build/list",
-                                   params={"ownername": owner_name,
-                                           "projectname": project_name,
-                                           }) as r:
-                            r.raise_for_status()
-                            builds = r.json().get("items", [])
-
-                        for build in builds:
-                            if build["state"] == "failed":
-                                continue
-
-                            if ((build_package_name := build["source_package"]["name"]) and
-                                    build_package_name != package_name):
-                                continue
-
-                            def get_version():
-                                ver = build["source_package"]["version"]
-                                if not ver:
-                                    return ver
-                                if ignore_epoch and ":" in ver:
-                                    ver = ver[ver.index(":") + 1:]
-                                return ver
-
-                            version = get_version()
-                            if build["state"] in ("pending", "importing", "starting", "running") or not build[
-                                "ended_on"]:
-                                if wait_build:
-                                    retry = True
-                                    print(
-                                        f"found build id {build['id']} package {build_package_name or '<unknown>'} "
-                                        f"version {version or '<unknown>'} {build['state']}"
-                                        f" - will retry in {spin_loop_delay} seconds")
-                                    sleep(spin_loop_delay)
-                                    break
-                                else:
-                                    continue
-
-                            arches = build["chroots"]
-                            bm = {
-                                "id": build["id"],
-                                "dir_id": basename(dirname(build["source_package"]["url"])),
-                                "version": version,
-                                "ended_on": build["ended_on"],
-                                "source_rpm": build["source_package"]["url"],
-                                "package_name": build["source_package"]["name"],
-                                "repo_url": build["repo_url"]
-                            }
-                            if not check_url_exists(bm["source_rpm"]):
-                                continue
-
-                            version_arches = build_metadata.setdefault(version, {})
-                            for arch in arches:
-                                existing_bm = version_arches.setdefault(arch, bm)
-                                if existing_bm is bm:
-                                    continue
-                                if bm["ended_on"] > existing_bm["ended_on"]:
-                                    version_arches[arch] = bm
-
-                    return build_metadata
-
-                build_metadata = get_builds()
-
-                def get_build_dir_name(build, platform_arch):
-                    return f"{build['repo_url']}/{platform_arch}/{build['dir_id']}-{build['package_name']}"
-
-                def get_arch_url(build, platform_arch: str, build_result: dict):
-                    platform, arch = platform_arch[:platform_arch.rindex("-")], platform_arch[
-                                                                                platform_arch.rindex("-") + 1:]
-                    rpm_name = (
-                        f"{build_result['epoch'] + ':' if build_result['epoch'] and build_result['epoch'] > 1 else ''}"
-                        f"{build_result['name']}-{build_result['version']}-{build_result['release']}.{build_result['arch']}.rpm")
-                    return (f"{platform}-{rpm_name}",
-                            f"{get_build_dir_name(build, platform_arch)}/{rpm_name}")
-
-                def get_build_results(build, platform_arch: str):
-                    results_url = f"{get_build_dir_name(build, platform_arch)}/results.json"
-                    with s.get(results_url) as r:
-                        if r.status_code == 404:
-                            return []
-                        else:
+    poll_initial = args.poll_initial
+    poll_max = args.poll_max
+    cache_dir = args.cache_dir
+
+    async with httpx.AsyncClient(http2=True,
+                                 limits=httpx.Limits(max_connections=50, max_keepalive_connections=50),
+                                 timeout=httpx.Timeout(60),
+                                 follow_redirects=True) as s:
+        url_exists_cache: dict[str, asyncio.Future[bool]] = {}
+
+        async def probe_url_exists(url):
+            async with s.stream("GET", url, headers={"Range": "bytes=0-0"}) as r:
+                return r.status_code in (200, 206)
+
+        async def probe_url_size(url):
+            async with s.stream("GET", url, headers={"Range": "bytes=0-0"}) as r:
+                if r.status_code == 206:
+                    size = r.headers.get("Content-Range", "").rpartition("/")[2]
+                elif r.status_code == 200:
+                    size = r.headers.get("Content-Length", "")
+                else:
+                    return None
+                return int(size) if size.isdigit() else None
+
+        async def check_url_exists(url):
+            if (url_exists := url_exists_cache.get(url)) is None:
+                url_exists = url_exists_cache[url] = asyncio.ensure_future(probe_url_exists(url))
+            return await url_exists
+
+        def is_build_pending(build):
+            return build["state"] in ("pending", "importing", "starting", "running") or not build["ended_on"]
+
+        def get_build_version(build):
+            ver = build["source_package"]["version"]
+            if not ver:
+                return ver
+            if ignore_epoch and ":" in ver:
+                ver = ver[ver.index(":") + 1:]
+            return ver
+
+        build_etags: dict[int, str] = {}
+
+        async def get_build(build):
+            build_id = build["id"]
+            r = await s.get(f"https://copr.fedorainfracloud.org/api_3/build/{build_id}",
+                            headers={"If-None-Match": etag} if (etag := build_etags.get(build_id)) else None)
+            if r.status_code == 304:
+                return build
+            r.raise_for_status()
+            if etag := r.headers.get("ETag"):
+                build_etags[build_id] = etag
+            return json_loads(r.content)
+
+        async def get_builds():
+            r = await s.get("https://copr.fedorainfracloud.org/api_3/build/list",
+                            params={"ownername": owner_name,
+                                    "projectname": project_name,
+                                    })
+            r.raise_for_status()
+            builds = {}
+            for build in json_loads(r.content).get("items", []):
+                if build["state"] == "failed":
+                    continue
+
+                if build["source_package"]["name"] and build["source_package"]["name"] != package_name:
+                    continue
+
+                builds[build["id"]] = build
+
+            delay = poll_initial
+            while wait_build and (pending_ids := [build_id for build_id, build in builds.items()
+                                                  if is_build_pending(build)]):
+                retry_delay = delay + random.uniform(0, delay * 0.25)
+                for build_id in pending_ids:
+                    build = builds[build_id]
+                    print(
+                        f"found build id {build_id} package {build['source_package']['name'] or '<unknown>'} "
+                        f"version {get_build_version(build) or '<unknown>'} {build['state']}"
+                        f" - will retry in {retry_delay:.1f} seconds")
+                await asyncio.sleep(retry_delay)
+                delay = min(delay * 2, poll_max)
+
+                for build in await asyncio.gather(*(get_build(builds[build_id]) for build_id in pending_ids)):
+                    builds[build["id"]] = build
+
+            candidate_builds = []
+            for build in builds.values():
+                if build["state"] == "failed" or is_build_pending(build):
+                    continue
+
+                # pending builds may not have had their source imported yet, so re-check the package name
+                if build["source_package"]["name"] != package_name:
+                    continue
+
+                arches = build["chroots"]
+                bm = {
+                    "id": build["id"],
+                    "dir_id": build["source_package"]["url"].rpartition("/")[0].rpartition("/")[2],
+                    "version": get_build_version(build),
+                    "ended_on": build["ended_on"],
+                    "source_rpm": build["source_package"]["url"],
+                    "package_name": build["source_package"]["name"],
+                    "repo_url": build["repo_url"]
+                }
+                candidate_builds.append((bm, arches))
+
+            build_metadata = {}
+            await asyncio.gather(*(check_url_exists(bm["source_rpm"]) for bm, _ in candidate_builds))
+            for bm, arches in candidate_builds:
+                if not url_exists_cache[bm["source_rpm"]].result():
+                    continue
+
+                version_arches = build_metadata.setdefault(bm["version"], {})
+                for arch in arches:
+                    existing_bm = version_arches.get(arch)
+                    if existing_bm is None or bm["ended_on"] > existing_bm["ended_on"]:
+                        version_arches[arch] = bm
+
+            return build_metadata
+
+        build_metadata = await get_builds()
+
+        def get_build_dir_name(build, platform_arch):
+            return f"{build['repo_url']}/{platform_arch}/{build['dir_id']}-{build['package_name']}"
+
+        def get_arch_url(build_dir_name: str, platform: str, build_result: dict):
+            rpm_name = (
+                f"{build_result['epoch'] + ':' if build_result['epoch'] and build_result['epoch'] > 1 else ''}"
+                f"{build_result['name']}-{build_result['version']}-{build_result['release']}.{build_result['arch']}.rpm")
+            return (f"{platform}-{rpm_name}",
+                    f"{build_dir_name}/{rpm_name}")
+
+        def get_build_cache_path(build, platform_arch):
+            return f"{cache_dir}/{build['dir_id']}-{platform_arch}.json"
+
+        def load_build_cache(build, platform_arch):
+            try:
+                with open(get_build_cache_path(build, platform_arch)) as f:
+                    build_cache = json.load(f)
+            except FileNotFoundError:
+                return None
+
+            loop = asyncio.get_running_loop()
+            for url, url_exists in build_cache["url_exists"].items():
+                if url_exists and url not in url_exists_cache:
+                    url_exists_cache[url] = loop.create_future()
+                    url_exists_cache[url].set_result(url_exists)
+            return build_cache["results"]
+
+        def save_build_cache(build, platform_arch, build_results, urls):
+            makedirs(cache_dir, exist_ok=True)
+            build_cache = {"results": build_results,
+                           "url_exists": {url: url_exists_cache[url].result() for url in urls},
+                           }
+            with tempfile.NamedTemporaryFile("w", dir=cache_dir, delete=False) as f:
+                json.dump(build_cache, f)
+            replace(f.name, get_build_cache_path(build, platform_arch))
+
+        async def get_build_results(build, platform_arch: str, build_dir_name: str):
+            if (build_results := load_build_cache(build, platform_arch)) is not None:
+                return build_results, False
+
+            results_url = f"{build_dir_name}/results.json"
+            r = await s.get(results_url)
+            if r.status_code == 404:
+                return [], False
+            else:
+                r.raise_for_status()
+            return json_loads(r.content)["packages"], True
+
+        arch_builds = [(k, arch, arch_bm, get_build_dir_name(arch_bm, arch), arch.rpartition("-")[0])
+                       for k, build in build_metadata.items()
+                       for arch, arch_bm in sorted(build.items(), key=lambda item: item[1]["ended_on"],
+                                                   reverse=True)]
+        arch_build_results = await asyncio.gather(*(get_build_results(arch_bm, arch, build_dir_name)
+                                                    for _, arch, arch_bm, build_dir_name, _ in arch_builds))
+
+        # GitHub assets are unique by name, so key each version's files by file name; each version's chroots
+        # are visited newest build first so a source RPM shared by name across builds comes from the latest one
+        version_file_urls: dict[str, dict[str, str]] = {}
+        arch_files = []
+        uncached_builds = []
+        for (k, arch, arch_bm, build_dir_name, platform), (build_results, cache_results) in zip(
+                arch_builds, arch_build_results):
+            version_file_urls.setdefault(k, {}).setdefault(basename(arch_bm["source_rpm"]), arch_bm["source_rpm"])
+            build_urls = []
+            for build_result in build_results:
+                if build_result["arch"] == "src":
+                    continue
+                file_name, url = get_arch_url(build_dir_name, platform, build_result)
+                arch_files.append((k, file_name, url))
+                build_urls.append(url)
+            if cache_results:
+                uncached_builds.append((arch_bm, arch, build_results, build_urls))
+
+        await asyncio.gather(*(check_url_exists(url) for _, _, url in arch_files))
+        for arch_bm, arch, build_results, build_urls in uncached_builds:
+            if all(url_exists_cache[url].result() for url in build_urls):
+                save_build_cache(arch_bm, arch, build_results, build_urls)
+
+        for k, file_name, url in arch_files:
+            if url_exists_cache[url].result():
+                version_file_urls[k].setdefault(file_name, url)
+            else:
+                print("NOT FOUND:", k, file_name, url)
+        version_files = {k: tuple(files.items()) for k, files in version_file_urls.items()}
+
+        if fetch_tags:
+            run(["git", "fetch", "--tags", "--force"])
+
+        def get_tags():
+            if tag:
+                return [tag]
+            return run(["git", "tag", "-l"], text=True).splitlines(False)
+
+        tags = get_tags()
+        if tag_to_version_re:
+            tag_map = {current_tag: m[1] for current_tag in tags if (m := tag_to_version_re.match(current_tag))}
+        else:
+            tag_map = {current_tag: current_tag for current_tag in tags}
+
+        if tag and tag not in tag_map:
+            print(f"tag {tag} does not match {tag_to_version_re.pattern}")
+            sys.exit(100)
+
+        ops = []
+        for current_tag, rpm_version in tag_map.items():
+            print()
+            print(f"processing tag {current_tag}")
+            print(f"tag {current_tag} maps to rpm version {rpm_version}")
+
+            if not rpm_version in version_files:
+                print(f"no asset files found for tag {current_tag} rpm version {rpm_version}")
+                if tag:
+                    sys.exit(100)
+                continue
+
+            ops.append((current_tag, rpm_version))
+
+        if not ops:
+            return
+
+        def get_github_repo():
+            remote_url = run(["git", "remote", "get-url", "origin"], text=True).strip()
+            if not (m := github_remote_re.match(remote_url)):
+                raise ValueError(f"unable to determine GitHub repository from remote URL {remote_url}")
+            return m[1]
+
+        github_repo = get_github_repo()
+        github_token = run(["gh", "auth", "token"], text=True).strip()
+        github_headers = {"Authorization": f"Bearer {github_token}",
+                          "Accept": "application/vnd.github+json",
+                          }
+
+        github_api_url = f"https://api.github.com/repos/{github_repo}"
+
+        async def get_releases_page(page):
+            r = await s.get(f"{github_api_url}/releases",
+                            params={"per_page": 100, "page": page},
+                            headers=github_headers)
+            r.raise_for_status()
+            return r
+
+        async def get_releases():
+            r = await get_releases_page(1)
+            releases = json_loads(r.content)
+            if last_link := r.links.get("last"):
+                last_page = int(parse_qs(urlsplit(last_link["url"]).query)["page"][0])
+                for r in await asyncio.gather(*(get_releases_page(page) for page in range(2, last_page + 1))):
+                    releases.extend(json_loads(r.content))
+            return releases
+
+        existing_releases: dict[str, dict] = {release["tag_name"]: release for release in await get_releases()}
+
+        async def create_release(current_tag):
+            r = await s.get(f"{github_api_url}/git/ref/tags/{quote(current_tag)}", headers=github_headers)
+            if r.status_code == 404:
+                raise ValueError(f"tag {current_tag} doesn't exist in GitHub repository {github_repo}")
+            r.raise_for_status()
+
+            r = await s.post(f"{github_api_url}/releases",
+                             json={"tag_name": current_tag,
+                                   "generate_release_notes": True,
+                                   },
+                             headers=github_headers)
+            r.raise_for_status()
+            return json_loads(r.content)
+
+        upload_semaphore = asyncio.Semaphore(6)
+
+        async def upload_asset(release, url, file_name):
+            async with upload_semaphore:
+                async with s.stream("GET", url, headers={"Accept-Encoding": "identity"}) as src:
+                    src.raise_for_status()
+                    if (content_length := src.headers.get("Content-Length")) is not None:
+                        content = src.aiter_raw(1024 * 1024)
+                    else:
+                        content = await src.aread()
+                        content_length = str(len(content))
+
+                    for asset in release["assets"]:
+                        if asset["name"] == file_name:
+                            r = await s.delete(f"{github_api_url}/releases/assets/{asset['id']}",
+                                               headers=github_headers)
                             r.raise_for_status()
-                        return r.json()["packages"]
-
-                version_files = {}
-                for k, build in build_metadata.items():
-                    files = set()
-                    for arch in build:
-                        arch_bm = build[arch]
-                        files.add((basename(arch_bm["source_rpm"]), arch_bm["source_rpm"]))
-                        for build_result in get_build_results(arch_bm, arch):
-                            if build_result["arch"] == "src":
-                                continue
-                            file_name, url = get_arch_url(arch_bm, arch, build_result)
-                            if check_url_exists(url):
-                                files.add((file_name, url))
-                            else:
-                                print("NOT FOUND:", k, file_name, url)
-                    if files:
-                        version_files[k] = files
-
-                if fetch_tags:
-                    run(["git", "fetch", "--tags", "--force"])
-
-                def normalize_tag(tag):
-                    if tag_to_version_re:
-                        return tag_to_version_re.match(tag)[1]
-                    return tag
-
-                def get_tags():
-                    if tag:
-                        return [tag]
-                    return run(["git", "tag", "-l"], text=True).splitlines(False)
-
-                def get_file(args):
-                    rpm_assets_dir, rpm_version, file_name, url = args
-                    with s.get(url, stream=True) as r:
-                        r.raise_for_status()
-                        print(f"downloading file {rpm_version}/{file_name}")
-                        rpm_asset = f"{rpm_assets_dir}/{file_name}"
-                        with open(f"{rpm_asset}", "wb") as tmp_file:
-                            for data in r.iter_content(chunk_size=1024 * 1024):
-                                tmp_file.write(data)
-
-                        return f"{rpm_asset}#{file_name}"
-
-                def get_files(rpm_version):
-                    rpm_assets_dir = f"{tmp_dir}/{rpm_version}"
-                    makedirs(rpm_assets_dir, exist_ok=True)
-                    return tpe.map(get_file, ((rpm_assets_dir, rpm_version, file_name, url)
-                                              for file_name, url in version_files[rpm_version]))
-
-                for current_tag in get_tags():
-                    print()
-                    print(f"processing tag {current_tag}")
-                    rpm_version = normalize_tag(current_tag)
-                    print(f"tag {current_tag} maps to rpm version {rpm_version}")
-
-                    if not rpm_version in version_files:
-                        print(f"no asset files found for tag {current_tag} rpm version {rpm_version}")
-                        if tag:
-                            sys.exit(100)
+
+                    r = await s.post(release["upload_url"].partition("{")[0],
+                                     params={"name": file_name, "label": file_name},
+                                     content=content,
+                                     headers={**github_headers,
+                                              "Content-Type": "application/octet-stream",
+                                              "Content-Length": content_length,
+                                              })
+                    r.raise_for_status()
+
+        upload_workers = 8
+        upload_queue = asyncio.Queue(maxsize=2)
+
+        async def is_asset_current(asset_sizes, url, file_name):
+            if (asset_size := asset_sizes.get(file_name)) is None:
+                return False
+            return await probe_url_size(url) == asset_size
+
+        async def get_changed_files(release, files):
+            asset_sizes = {asset["name"]: asset["size"] for asset in release["assets"]
+                           if asset["state"] == "uploaded"}
+            assets_current = await asyncio.gather(*(is_asset_current(asset_sizes, url, file_name)
+                                                    for file_name, url in files))
+            return tuple(file for file, asset_current in zip(files, assets_current) if not asset_current)
+
+        async def queue_uploads():
+            for current_tag, rpm_version in ops:
+                release = existing_releases.get(current_tag)
+                if release and not clobber_assets:
+                    print(f"Release {current_tag} already exists and no '--clobber' is specified")
+                    continue
+
+                files = version_files[rpm_version]
+                if release:
+                    files = await get_changed_files(release, files)
+                    if not files:
+                        print(f"Release {current_tag} assets are already up to date")
                         continue
 
-                    try:
-                        run(["gh", "release", "view", "--json", "tagName", current_tag], stderr=STDOUT, text=True)
-                        release_found = True
-                    except CalledProcessError as e:
-                        if e.output and e.output.strip() != "release not found":
-                            raise e
-                        release_found = False
-
-                    if not release_found:
-                        print(f"creating release for tag {current_tag}")
-                        exe(["gh", "release", "create", current_tag, "--verify-tag", "--generate-notes"], text=True)
-
-                    if not release_found or clobber_assets:
-                        upload_files = list(get_files(rpm_version))
-                        print(f"uploading files into release {current_tag}: {', '.join(map(basename, upload_files))}")
-                        exe(["gh", "release", "upload", current_tag] + upload_files + ["--clobber"], text=True)
-                    else:
-                        print(f"Release {current_tag} already exists and no '--clobber' is specified")
+                await upload_queue.put((current_tag, release, files))
+
+            for _ in range(upload_workers):
+                await upload_queue.put(None)
+
+        async def upload_assets():
+            while (item := await upload_queue.get()) is not None:
+                current_tag, release, upload_files = item
+                if not release:
+                    print(f"creating release for tag {current_tag}")
+                    release = await create_release(current_tag)
+
+                print(f"uploading files into release {current_tag}: "
+                      f"{', '.join(file_name for file_name, _ in upload_files)}")
+                # uploads run concurrently and clobber by name against the initial release listing, so each
+                # asset name must be uploaded at most once per release
+                await asyncio.gather(*(upload_asset(release, url, file_name)
+                                       for file_name, url in dict(upload_files).items()))
+
+        await asyncio.gather(queue_uploads(), *(upload_assets() for _ in range(upload_workers)))
 
 
 if __name__ == "__main__":
-    main()
+    if sys.platform == "linux":
+        try:
+            import uringcore
+
+            asyncio.set_event_loop_policy(uringcore.EventLoopPolicy())
+        except ImportError:
+            pass
+    asyncio.run(main())